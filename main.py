@@ -1,4 +1,6 @@
+import os
 import torch
+import torch.distributed as dist
 import numpy as np
 import json
 import click
@@ -24,6 +26,10 @@ def main():
 
 @main.command()
 def train():
+    # Join the process group when launched with torchrun
+    if "WORLD_SIZE" in os.environ:
+        dist.init_process_group("gloo")
+
     # Load word vectors
     word_vectors = load_word_vectors(WORD_VECTORS_FILE)
 
@@ -32,7 +38,8 @@ def train():
 
     # Load dialogues
     dataset = MultiWoz(TRAINING_FILE, word_vectors, ontology, DOMAINS, max_utterance_length, max_turn_length, vector_dimension)
-    dataloader = torch.utils.data.DataLoader(dataset=dataset, batch_size=3, collate_fn=collate_fn)
+    sampler = ShardSampler(dataset) if dataset.world_size > 1 else None
+    dataloader = torch.utils.data.DataLoader(dataset=dataset, batch_size=3, sampler=sampler, collate_fn=collate_fn)
 
 
 @main.command()
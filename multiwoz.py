@@ -1,12 +1,31 @@
 import torch
-from torch.utils.data import Dataset, DataLoader
+import torch.distributed as dist
+from torch.utils.data import Dataset, DataLoader, Sampler
 import os
+import math
 import json
 from util import *
 
 
 class MultiWoz(Dataset):
-    def __init__(self, root, word_vectors, ontology, domains, max_utterance_length, max_turn_length, vector_dimension):
+    def __init__(self, root, word_vectors, ontology, domains, max_utterance_length, max_turn_length, vector_dimension,
+                 query=None, rank=None, world_size=None, seed=0):
+        """
+        :param query: keyword arguments for query_woz_index; when given, only the matching dialogues are read
+        :param rank: defaults to the rank of the initialised process group, if any
+        :param world_size: defaults to the size of the initialised process group, if any
+        :param seed: seed of the permutation the dialogues are sharded by, shared by all ranks
+        """
+        if rank is None or world_size is None:
+            if dist.is_available() and dist.is_initialized():
+                rank = dist.get_rank() if rank is None else rank
+                world_size = dist.get_world_size() if world_size is None else world_size
+            elif rank is None and world_size is None:
+                rank, world_size = 0, 1
+            else:
+                raise ValueError("rank and world_size must be given together without a process group")
+        if not 0 <= rank < world_size:
+            raise ValueError("rank %d is out of range for world size %d" % (rank, world_size))
         self.root = root
         self.word_vectors = word_vectors
         self.ontology = ontology
@@ -14,7 +33,21 @@ class MultiWoz(Dataset):
         self.max_utterance_length = max_utterance_length
         self.max_turn_length = max_turn_length
         self.vector_dimension = vector_dimension
-        self.dialogues, _ = load_woz_data(root, word_vectors, ontology, domains, max_utterance_length, vector_dimension)
+        self.rank = rank
+        self.world_size = world_size
+        positions = None
+        index = None
+        if world_size > 1:
+            index = load_shared_woz_index(root)
+            positions, self.num_samples = select_woz_shard(index, domains, max_utterance_length, rank, world_size,
+                                                           seed, query)
+        elif query is not None:
+            index = load_shared_woz_index(root)
+            positions = query_woz_index(index, **query)
+        self.dialogues, _ = load_woz_data(root, word_vectors, ontology, domains, max_utterance_length, vector_dimension,
+                                          positions, index)
+        if world_size == 1:
+            self.num_samples = len(self.dialogues)
 
     def __getitem__(self, index):
         (num_turn, user_vecs, sys_vecs, turn_labels, turn_domain_labels) = self.dialogues[index]
@@ -39,6 +72,56 @@ class MultiWoz(Dataset):
         return len(self.dialogues)
 
 
+def load_shared_woz_index(root):
+    """
+    Load the index of a split file. Within a process group only rank 0 (re)builds it, the other ranks
+    wait for it before reading.
+    """
+    if not (dist.is_available() and dist.is_initialized()):
+        return load_woz_index(root)
+    index = None
+    if dist.get_rank() == 0:
+        index = load_woz_index(root)
+    dist.barrier()
+    if index is None:
+        index = load_woz_index(root)
+    return index
+
+
+class ShardSampler(Sampler):
+    """
+    Iterates over the local shard of a MultiWoz dataset. The order is reshuffled every epoch from the
+    same seed on every rank, and shards are padded by repetition so that all ranks yield the same
+    number of samples.
+    """
+    def __init__(self, dataset, shuffle=True, seed=0):
+        if len(dataset) == 0 and dataset.num_samples > 0:
+            raise ValueError("rank %d has no dialogues to yield its %d samples from"
+                             % (dataset.rank, dataset.num_samples))
+        self.dataset = dataset
+        self.num_samples = dataset.num_samples
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        if indices:
+            indices = (indices * int(math.ceil(self.num_samples / len(indices))))[:self.num_samples]
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
 def collate_fn(data):
     num_turns, user_uttrs, sys_uttrs, user_uttr_lens, sys_uttr_lens, turn_labels, turn_domain_labels = zip(*data)
     num_turns = torch.tensor(num_turns)
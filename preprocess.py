@@ -101,6 +101,9 @@ def main(args):
     with open('data/ontology.json', 'w') as outfile:
         json.dump(ontology, outfile, indent=4)
 
+    for path in ['data/train.json', 'data/validate.json', 'data/test.json']:
+        build_woz_index(path)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -0,0 +1,76 @@
+import os
+import sys
+import json
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+
+def make_turn(user, system, state):
+    belief_state = {}
+    for domain, slots in state.items():
+        belief_state[domain] = {"semi": slots, "book": {"booked": []}}
+    return {"user": {"text": user, "belief_state": belief_state}, "system": system}
+
+
+def make_dialogue(domains, turns):
+    dialogue = {domain: domain in domains for domain in ["restaurant", "taxi", "train", "attraction", "hotel"]}
+    for idx, turn in enumerate(turns):
+        dialogue[str(idx)] = make_turn(*turn)
+    dialogue["len"] = len(turns)
+    return dialogue
+
+
+@pytest.fixture
+def woz_dialogues():
+    return [
+        # Taxi only, with non-ASCII text; the last system response is never fed to the model
+        make_dialogue(["taxi"], [
+            ("I need a taxi to the café Jello", "sure, where from? " + "really " * 20,
+             {"taxi": {"destination": "café jello", "departure": ""}}),
+        ]),
+        # Taxi and restaurant
+        make_dialogue(["taxi", "restaurant"], [
+            ("a taxi leaving at 09:45", "ok", {"taxi": {"leave at": "09:45"}}),
+            ("and a restaurant in the east", "done", {"taxi": {"leave at": "09:45"}, "restaurant": {"area": "east"}}),
+        ]),
+        # Hotel only, the name alone is not an active slot
+        make_dialogue(["hotel"], [
+            ("find me the acorn guest house", "it is in the east", {"hotel": {"name": "acorn guest house"}}),
+            ("book it for 2 people", "booked", {"hotel": {"name": "acorn guest house", "book people": "2"}}),
+            ("what area is it in", "east", {"hotel": {"area": "east", "book people": "2"}}),
+        ]),
+        # Taxi only, three turns with a long system response in the middle
+        make_dialogue(["taxi"], [
+            ("taxi please", "where to", {"taxi": {}}),
+            ("to the café jello", "when " * 12, {"taxi": {"destination": "café jello"}}),
+            ("leave at 09:45", "booked", {"taxi": {"destination": "café jello", "leave at": "09:45"}}),
+        ]),
+        # Taxi goal that never fills a slot
+        make_dialogue(["taxi"], [
+            ("hello", "hi", {"taxi": {"destination": ""}}),
+        ]),
+    ]
+
+
+@pytest.fixture
+def woz_ontology():
+    return {
+        "hotel-area": ["east", "west"],
+        "hotel-book people": ["2"],
+        "hotel-name": ["acorn guest house"],
+        "restaurant-area": ["east", "west", "centre"],
+        "taxi-departure": ["café jello"],
+        "taxi-destination": ["café jello"],
+        "taxi-leave at": ["09:45", "10:30"],
+    }
+
+
+@pytest.fixture
+def woz_split(tmp_path, woz_dialogues, woz_ontology):
+    path = str(tmp_path / "train.json")
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump(woz_dialogues, f, indent=4, ensure_ascii=False)
+    with open(str(tmp_path / "ontology.json"), 'w', encoding='utf8') as f:
+        json.dump(woz_ontology, f, indent=4, ensure_ascii=False)
+    return path
@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+import pytest
+
+torch = pytest.importorskip("torch")
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from conftest import make_dialogue
+from util import *
+from multiwoz import MultiWoz, ShardSampler
+
+DOMAINS = ['restaurant', 'hotel', 'attraction', 'train', 'taxi']
+MAX_UTTERANCE_LENGTH = 40
+MAX_TURN_LENGTH = 5
+VECTOR_DIMENSION = 300
+
+
+def fingerprint(dialogue):
+    (num_turn, user_vecs, sys_vecs, turn_labels, turn_domain_labels) = dialogue
+    digest = hashlib.sha1(str(num_turn).encode())
+    for arrays in (user_vecs, sys_vecs, turn_labels, turn_domain_labels):
+        for array in arrays:
+            digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def load_dataset(root, rank=None, world_size=None):
+    word_vectors = {}
+    ontology, _, _ = load_ontoloty(os.path.join(root, "ontology.json"), word_vectors, DOMAINS)
+    return MultiWoz(os.path.join(root, "train.json"), word_vectors, ontology, DOMAINS, MAX_UTTERANCE_LENGTH,
+                    MAX_TURN_LENGTH, VECTOR_DIMENSION, rank=rank, world_size=world_size)
+
+
+def run_rank(rank, world_size, root):
+    dist.init_process_group("gloo", init_method="file://" + os.path.join(root, "init"), rank=rank,
+                            world_size=world_size)
+    dataset = load_dataset(root)
+    sampler = ShardSampler(dataset, seed=3)
+    orders = []
+    for epoch in range(2):
+        sampler.set_epoch(epoch)
+        orders.append(list(sampler))
+    result = {"len": len(sampler), "size": len(dataset), "orders": orders,
+              "fingerprints": [fingerprint(dialogue) for dialogue in dataset.dialogues]}
+    with open(os.path.join(root, "rank%d.json" % rank), 'w') as f:
+        json.dump(result, f)
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+@pytest.fixture
+def woz_corpus(tmp_path, woz_ontology):
+    dialogues = []
+    for idx in range(16):
+        # Unknown words, some of which split into others, exercise the random vectors of unseen words
+        dialogues.append(make_dialogue(["taxi"] if idx % 3 else ["taxi", "restaurant"], [
+            ("zqx%d taxicab to the café jello" % idx, "cab zqx%d ok" % (idx + 1),
+             {"taxi": {"destination": "café jello"}}),
+            ("leave at %s" % ["09:45", "10:30"][idx % 2], "booked",
+             {"taxi": {"destination": "café jello", "leave at": ["09:45", "10:30"][idx % 2]}}),
+        ]))
+    with open(str(tmp_path / "train.json"), 'w', encoding='utf8') as f:
+        json.dump(dialogues, f, ensure_ascii=False)
+    with open(str(tmp_path / "ontology.json"), 'w', encoding='utf8') as f:
+        json.dump(woz_ontology, f, ensure_ascii=False)
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("world_size", [2, 3])
+def test_shards_across_processes(woz_corpus, world_size):
+    expected = [fingerprint(dialogue) for dialogue in load_dataset(woz_corpus).dialogues]
+    assert len(expected) == 16
+
+    mp.spawn(run_rank, args=(world_size, woz_corpus), nprocs=world_size)
+    results = [json.load(open(os.path.join(woz_corpus, "rank%d.json" % rank))) for rank in range(world_size)]
+
+    # The shards are disjoint, cover the corpus and hold the same features a single process builds
+    sharded = [fp for result in results for fp in result["fingerprints"]]
+    assert sorted(sharded) == sorted(expected)
+
+    # Every rank yields the same number of samples
+    assert len(set(result["len"] for result in results)) == 1
+    assert all(len(order) == results[0]["len"] for result in results for order in result["orders"])
+
+    # Ranks holding as many dialogues shuffle them identically, and differently every epoch
+    for result in results:
+        assert result["orders"][0] != result["orders"][1]
+        for other in results:
+            if other["size"] == result["size"]:
+                assert other["orders"] == result["orders"]
+
+
+def test_explicit_rank_needs_world_size(woz_corpus):
+    with pytest.raises(ValueError):
+        load_dataset(woz_corpus, rank=1)
+    with pytest.raises(ValueError):
+        load_dataset(woz_corpus, rank=2, world_size=2)
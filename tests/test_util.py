@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+from util import *
+
+
+def test_woz_index_records_dialogues(woz_split):
+    index = load_woz_index(woz_split)
+    assert os.path.isfile(woz_index_path(woz_split))
+    entries = index["dialogues"]
+    assert [entry["domains"] for entry in entries] == [["taxi"], ["restaurant", "taxi"], ["hotel"], ["taxi"], ["taxi"]]
+    assert [entry["num_turns"] for entry in entries] == [1, 2, 3, 3, 1]
+    assert entries[0]["slots"] == ["taxi-destination"]
+    assert entries[2]["slots"] == ["hotel-area", "hotel-book people"]
+    assert entries[4]["slots"] == []
+
+
+def test_woz_index_skips_last_system_response(woz_split):
+    entries = load_woz_index(woz_split)["dialogues"]
+    # Only the user utterance counts for a single turn dialogue
+    assert entries[0]["max_utterance_length"] == 8
+    # Earlier system responses are model inputs and do count
+    assert entries[3]["max_utterance_length"] == 12
+
+
+def test_read_woz_dialogues_matches_json(woz_split):
+    index = load_woz_index(woz_split)
+    data = json.load(open(woz_split, encoding='utf8'))
+    positions = [3, 0, 2]
+    assert read_woz_dialogues(woz_split, index, positions) == [data[p] for p in positions]
+
+
+def test_query_woz_index(woz_split):
+    index = load_woz_index(woz_split)
+    assert query_woz_index(index, domains=['taxi']) == [0, 3]
+    assert query_woz_index(index, domains=['taxi'], max_turns=1) == [0]
+    assert query_woz_index(index, domains=['taxi', 'restaurant']) == [0, 1, 3]
+    assert query_woz_index(index, labelled_domains=['taxi']) == [0, 1, 3]
+    assert query_woz_index(index, max_utterance_length=10) == [0, 1, 2, 4]
+    assert query_woz_index(index, slots=['hotel-book people']) == [2]
+
+
+def test_load_woz_index_rebuilds_stale_index(woz_split, woz_dialogues):
+    load_woz_index(woz_split)
+    with open(woz_split, 'w', encoding='utf8') as f:
+        json.dump(woz_dialogues[:2], f, ensure_ascii=False)
+    index = load_woz_index(woz_split)
+    assert len(index["dialogues"]) == 2
+    assert read_woz_dialogues(woz_split, index, [1]) == [json.loads(json.dumps(woz_dialogues[1]))]
+
+
+def test_xavier_vector_is_the_same_in_every_process():
+    script = "import sys; sys.path.insert(0, %r); from util import xavier_vector; print(list(xavier_vector('zzqx')[:5]))" \
+             % os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    outputs = set()
+    for seed in ["1", "2"]:
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        outputs.add(subprocess.check_output([sys.executable, "-c", script], env=env))
+    assert len(outputs) == 1
+
+
+def test_process_text_leaves_word_vectors_untouched():
+    word_vectors = {"taxi": xavier_vector("taxi")}
+    first = process_text("cab taxicab", word_vectors)
+    assert list(word_vectors) == ["taxi"]
+    # Seeing "cab" first does not make "taxicab" split into "taxi" and "cab"
+    assert np.allclose(process_text("taxicab", word_vectors)[0], xavier_vector("taxicab"))
+    assert np.allclose(first[1], xavier_vector("taxicab"))
+
+
+def make_slot_ontology(path):
+    domains = ['restaurant', 'hotel', 'taxi']
+    ontology, _, slot_values = load_ontoloty(os.path.join(os.path.dirname(path), "ontology.json"), {}, domains)
+    return SlotOntology(ontology, slot_values)
+
+
+def test_slot_ontology_segments(woz_split):
+    layout = make_slot_ontology(woz_split)
+    assert layout.slots == [("hotel", "area"), ("hotel", "book people"), ("restaurant", "area"),
+                            ("taxi", "departure"), ("taxi", "destination"), ("taxi", "leave at")]
+    assert list(layout.offsets) == [0, 2, 3, 6, 7, 8, 10]
+    assert layout.ontology[layout.offsets[5]] == "taxi-leave at-09:45"
+
+
+def test_slot_ontology_labels_round_trip(woz_split):
+    layout = make_slot_ontology(woz_split)
+    ids = np.array([[1, 0, -1, -1, 0, 1], [-1, -1, 2, 0, -1, -1]])
+    labels = layout.ids_to_labels(ids)
+    assert labels.sum() == 6
+    assert (layout.labels_to_ids(labels) == ids).all()
+
+
+def test_slot_ontology_encodes_gold_belief_state(woz_split, woz_dialogues):
+    layout = make_slot_ontology(woz_split)
+    turn = woz_dialogues[2]["2"]["user"]["belief_state"]
+    taxi = {"taxi": {"semi": {"departure": "somewhere", "destination": "café jello", "leave at": ""},
+                     "book": {"booked": []}}}
+    ids = layout.belief_states_to_ids([turn, taxi])
+    # The hotel name is skipped, booking and place slots are only marked as mentioned
+    assert ids.tolist() == [[0, 0, -1, -1, -1, -1], [-1, -1, -1, 0, 0, -1]]
+    assert layout.ids_to_belief_states(ids) == [
+        {"hotel": {"area": "east", "book people": "people"}},
+        {"taxi": {"departure": "place", "destination": "place"}},
+    ]
+    # The gold labels match the ones used for training
+    labels = process_turn({"user": {"text": "", "belief_state": turn}, "system": ""}, {}, layout.ontology,
+                          ['restaurant', 'hotel', 'taxi'])[2]
+    assert (layout.belief_states_to_labels([turn])[0] == labels).all()
+
+
+def test_slot_ontology_rejects_unknown_values(woz_split):
+    layout = make_slot_ontology(woz_split)
+    with pytest.raises(ValueError, match="restaurant-area = north"):
+        layout.belief_states_to_ids([{"restaurant": {"area": "north"}}])
+
+
+def test_slot_ontology_thresholds_scores(woz_split):
+    layout = make_slot_ontology(woz_split)
+    scores = np.zeros(len(layout.ontology), dtype='float32')
+    scores[[0, 1]] = [0.7, 0.9]
+    scores[[3, 4, 5]] = [0.4, 0.3, 0.2]
+    scores[9] = 0.5
+    assert layout.scores_to_ids(scores).tolist() == [1, -1, -1, -1, -1, 1]
+    assert layout.scores_to_belief_states(scores) == {"hotel": {"area": "west"}, "taxi": {"leave at": "10:30"}}
+    # Ties go to the first value of the slot
+    scores[[3, 4, 5]] = 0.8
+    assert layout.scores_to_ids(scores)[2] == 0
+
+
+def test_slot_ontology_batched_shapes(woz_split):
+    layout = make_slot_ontology(woz_split)
+    rng = np.random.RandomState(0)
+    scores = rng.uniform(size=(4, 3, len(layout.ontology)))
+    ids = layout.scores_to_ids(scores)
+    assert ids.shape == (4, 3, len(layout))
+    for b in range(4):
+        for t in range(3):
+            assert (layout.scores_to_ids(scores[b, t]) == ids[b, t]).all()
+
+    states = layout.ids_to_belief_states(ids)
+    assert len(states) == 4 and all(len(turns) == 3 for turns in states)
+    assert states[1][2] == layout.ids_to_belief_states(ids[1, 2])
+    assert (layout.belief_states_to_ids(states) == ids).all()
+    assert layout.belief_states_to_labels(states).shape == scores.shape
@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import os
 import string
 import numpy as np
 import math
+import zlib
 import json
 from collections import OrderedDict
 
 
 def hash_string(s):
-    return abs(hash(s)) % (10 ** 8)
+    # Unlike hash(), crc32 is not salted per process, so every process draws the same vector for a word
+    return zlib.crc32(s.encode('utf8')) % (10 ** 8)
 
 
 def normalise_word_vectors(word_vectors, norm=1.0):
@@ -29,12 +32,12 @@ def xavier_vector(word, D=300):
     """
 
     seed_value = hash_string(word)
-    np.random.seed(seed_value)
+    rng = np.random.RandomState(seed_value)
 
     neg_value = - math.sqrt(6) / math.sqrt(D)
     pos_value = math.sqrt(6) / math.sqrt(D)
 
-    rsample = np.random.uniform(low=neg_value, high=pos_value, size=(D,))
+    rsample = rng.uniform(low=neg_value, high=pos_value, size=(D,))
     norm = np.linalg.norm(rsample)
     rsample_normed = rsample / norm
 
@@ -100,9 +103,151 @@ def load_ontoloty(path, word_vectors, domains):
     return ontology, np.asarray(ontology_vectors, dtype='float32'), slot_values
 
 
-def load_woz_data(path, word_vectors, ontology, domains, max_utterance_length, vector_dimension):
+def nest_list(items, shape):
+    """
+    Arrange a flat list into nested lists of the given shape; an empty shape returns the single item.
+    """
+    if not shape:
+        return items[0]
+    if shape[0] == 0:
+        return []
+    step = len(items) // shape[0]
+    return [nest_list(items[i * step:(i + 1) * step], shape[1:]) for i in range(shape[0])]
+
+
+def flatten_list(items):
+    """
+    Inverse of nest_list: return the dictionaries found in nested lists and the shape of the nesting.
+    """
+    if isinstance(items, dict):
+        return [items], ()
+    if len(items) == 0:
+        return [], (0,)
+    flat = []
+    for item in items:
+        item_flat, shape = flatten_list(item)
+        flat.extend(item_flat)
+    return flat, (len(items),) + shape
+
+
+class SlotOntology(object):
+    """
+    Slot-segmented view of the flat ontology returned by load_ontoloty. The values of each slot occupy a
+    contiguous segment of the label vector, starting at offsets[slot].
+
+    Per-slot class ids index into the values of a slot, with -1 meaning the slot is not mentioned.
+    Belief states are {domain: {slot: value}} dictionaries; booking and place slots only record that they
+    are mentioned, so they decode to the placeholder value the ontology keeps for them.
+    """
+    def __init__(self, ontology, slot_values):
+        self.ontology = ontology
+        self.sizes = np.asarray(slot_values, dtype='int64')
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes))).astype('int64')
+        assert self.offsets[-1] == len(ontology)
+
+        self.slots = []
+        self.values = []
+        self.lookup = {}
+        for idx in range(len(self.sizes)):
+            start, end = self.offsets[idx], self.offsets[idx + 1]
+            [domain, slot, value] = ontology[start].split('-', 2)
+            if slot == "book":
+                slot = "book " + value
+            self.slots.append((domain, slot))
+            self.values.append([entry.split('-', 2)[2] for entry in ontology[start:end]])
+            for class_id, entry in enumerate(ontology[start:end]):
+                self.lookup[entry] = (idx, class_id)
+        self.domains = set(domain for domain, _ in self.slots)
+        # Position of every ontology entry within its slot
+        self.class_ids = np.arange(len(ontology)) - np.repeat(self.offsets[:-1], self.sizes)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def scores_to_ids(self, scores, threshold=0.5):
+        """
+        Take the argmax within every slot, keeping it only when its score reaches the threshold.
+        :param scores: array of shape (..., len(ontology))
+        :param threshold:
+        :return: int array of shape (..., num_slots)
+        """
+        scores = np.asarray(scores, dtype='float32')
+        starts = self.offsets[:-1]
+        best = np.maximum.reduceat(scores, starts, axis=-1)
+        # The argmax of a slot is the first of its values reaching the maximum
+        candidates = np.where(scores == np.repeat(best, self.sizes, axis=-1), self.class_ids, len(self.ontology))
+        ids = np.minimum.reduceat(candidates, starts, axis=-1)
+        ids[best < threshold] = -1
+        return ids
+
+    def labels_to_ids(self, labels):
+        return self.scores_to_ids(labels)
+
+    def ids_to_labels(self, ids):
+        ids = np.asarray(ids, dtype='int64')
+        labels = np.zeros(ids.shape[:-1] + (len(self.ontology),), dtype='float32')
+        flat_ids = ids.reshape(-1, len(self.slots))
+        flat_labels = labels.reshape(-1, len(self.ontology))
+        rows, slots = np.nonzero(flat_ids >= 0)
+        flat_labels[rows, self.offsets[slots] + flat_ids[rows, slots]] = 1
+        return labels
+
+    def ids_to_belief_states(self, ids):
+        """
+        :param ids: int array of shape (..., num_slots)
+        :return: belief states nested in lists following the leading shape, a single one for 1-D ids
+        """
+        ids = np.asarray(ids)
+        states = []
+        for row in ids.reshape(-1, len(self.slots)):
+            state = {}
+            for idx in np.flatnonzero(row >= 0):
+                domain, slot = self.slots[idx]
+                state.setdefault(domain, {})[slot] = self.values[idx][row[idx]]
+            states.append(state)
+        return nest_list(states, ids.shape[:-1])
+
+    def belief_states_to_ids(self, states):
+        """
+        :param states: flat {domain: {slot: value}} belief states nested in lists, as returned by
+            ids_to_belief_states, or turn belief states from the preprocessed data, whose slots are read from 'semi'
+        :return: int array of shape (..., num_slots) following the nesting of states
+        """
+        flat, shape = flatten_list(states)
+        ids = np.full((len(flat), len(self.slots)), -1, dtype='int64')
+        for row, state in enumerate(flat):
+            for domain in state:
+                if domain not in self.domains:
+                    continue
+                slots = state[domain]
+                if 'semi' in slots:
+                    slots = slots['semi']
+                for slot, value in slots.items():
+                    slot_value = normalise_belief_slot(slot, value)
+                    if slot_value is not None:
+                        entry = domain + '-' + slot_value[0] + '-' + slot_value[1]
+                        if entry not in self.lookup:
+                            raise ValueError("%s = %s is not in the ontology" % (domain + '-' + slot, value))
+                        idx, class_id = self.lookup[entry]
+                        ids[row, idx] = class_id
+        return ids.reshape(shape + (len(self.slots),))
+
+    def belief_states_to_labels(self, states):
+        return self.ids_to_labels(self.belief_states_to_ids(states))
+
+    def scores_to_belief_states(self, scores, threshold=0.5):
+        return self.ids_to_belief_states(self.scores_to_ids(scores, threshold))
+
+
+def load_woz_data(path, word_vectors, ontology, domains, max_utterance_length, vector_dimension, positions=None,
+                  index=None):
     print("[Info] Loading woz data from file")
-    data = json.load(open(path, mode='r', encoding='utf8'))
+    if positions is None:
+        data = json.load(open(path, mode='r', encoding='utf8'))
+    else:
+        if index is None:
+            index = load_woz_index(path)
+        data = read_woz_dialogues(path, index, positions)
 
     dialogues = []
     actual_dialogues = []
@@ -140,6 +285,182 @@ def load_woz_data(path, word_vectors, ontology, domains, max_utterance_length, v
     return dialogues, actual_dialogues
 
 
+def woz_index_path(path):
+    return os.path.splitext(path)[0] + ".index.json"
+
+
+def build_woz_index(path):
+    """
+    Scan a split file once and record, for every dialogue, where it lives in the file together with
+    the domains present, the number of turns, the longest utterance (in words) and the active slots.
+    :param path:
+    :return:
+    """
+    print("[Info] Building woz index for %s" % path)
+    with open(path, mode='rb') as f:
+        raw = f.read()
+    text = raw.decode('utf8')
+    decoder = json.JSONDecoder()
+
+    entries = []
+    pos = text.index('[') + 1
+    offset = len(text[:pos].encode('utf8'))
+    while True:
+        while text[pos] in ' \t\n\r,':
+            offset += 1
+            pos += 1
+        if text[pos] == ']':
+            break
+        dialogue, end = decoder.raw_decode(text, pos)
+        length = len(text[pos:end].encode('utf8'))
+        entry = index_dialogue(dialogue)
+        entry["offset"] = offset
+        entry["length"] = length
+        entries.append(entry)
+        offset += length
+        pos = end
+
+    stat = os.stat(path)
+    index = {"size": stat.st_size, "mtime": stat.st_mtime, "dialogues": entries}
+    # Write next to the index and move it into place, so readers never see a partial file
+    index_path = woz_index_path(path)
+    tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+    with open(tmp_path, mode='w', encoding='utf8') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+    return index
+
+
+def index_dialogue(dialogue):
+    turn_ids = sorted(int(key) for key in dialogue.keys() if key.isdigit())
+    domains = [key for key, value in dialogue.items() if value is True]
+    max_length = 0
+    slots = set()
+    for i, key in enumerate(turn_ids):
+        turn = dialogue[str(key)]
+        max_length = max(max_length, count_words(turn['user']['text']))
+        # The system response is only fed to the model as context of the following turn
+        if i + 1 < len(turn_ids):
+            max_length = max(max_length, count_words(turn['system']))
+        state = turn['user']['belief_state']
+        for domain in state:
+            for slot, value in state[domain]['semi'].items():
+                if normalise_belief_slot(slot, value) is not None:
+                    slots.add(domain + '-' + slot)
+    return {"domains": domains, "num_turns": len(turn_ids), "max_utterance_length": max_length,
+            "slots": sorted(slots)}
+
+
+def load_woz_index(path):
+    """
+    Load the index of a split file, rebuilding it when it is missing or older than the split file.
+    :param path:
+    :return:
+    """
+    index_path = woz_index_path(path)
+    if os.path.isfile(index_path):
+        index = json.load(open(index_path, mode='r', encoding='utf8'))
+        stat = os.stat(path)
+        if index["size"] == stat.st_size and index["mtime"] == stat.st_mtime:
+            return index
+    return build_woz_index(path)
+
+
+def query_woz_index(index, domains=None, max_turns=None, max_utterance_length=None, slots=None,
+                    labelled_domains=None):
+    """
+    Return the positions of the indexed dialogues that match every given criterion.
+    :param index:
+    :param domains: only keep dialogues whose domains all lie within these and which mention at least one of them
+    :param max_turns:
+    :param max_utterance_length:
+    :param slots: "domain-slot" names that must all be active at some turn
+    :param labelled_domains: only keep dialogues with an active slot in one of these, as load_woz_data does
+    :return:
+    """
+    positions = []
+    for position, entry in enumerate(index["dialogues"]):
+        if domains is not None:
+            if not set(entry["domains"]) <= set(domains):
+                continue
+            if not any(slot.split('-')[0] in domains for slot in entry["slots"]):
+                continue
+        if labelled_domains is not None and not any(slot.split('-')[0] in labelled_domains for slot in entry["slots"]):
+            continue
+        if max_turns is not None and entry["num_turns"] > max_turns:
+            continue
+        if max_utterance_length is not None and entry["max_utterance_length"] > max_utterance_length:
+            continue
+        if slots is not None and not set(slots) <= set(entry["slots"]):
+            continue
+        positions.append(position)
+    return positions
+
+
+def shard_woz_positions(positions, rank, world_size, seed=0):
+    """
+    Deterministically split dialogue positions between ranks. Every rank draws the same permutation,
+    so the shards are disjoint and together cover all positions.
+    :param positions:
+    :param rank:
+    :param world_size:
+    :param seed:
+    :return: the positions of this rank in file order
+    """
+    order = np.random.RandomState(seed).permutation(len(positions))
+    return sorted(positions[i] for i in order[rank::world_size])
+
+
+def select_woz_shard(index, domains, max_utterance_length, rank, world_size, seed=0, query=None):
+    """
+    Select the dialogues a rank loads. Only the dialogues load_woz_data keeps are sharded, so the shards
+    together hold the same dialogues a single process loads and stay balanced.
+    :param index:
+    :param domains:
+    :param max_utterance_length:
+    :param rank:
+    :param world_size:
+    :param seed:
+    :param query: optional keyword arguments for query_woz_index narrowing the dialogues further
+    :return: the positions of this rank, and the number of samples every rank yields per epoch
+    """
+    kept = set(query_woz_index(index, labelled_domains=domains, max_utterance_length=max_utterance_length))
+    positions = [position for position in query_woz_index(index, **(query or {})) if position in kept]
+    num_samples = int(math.ceil(len(positions) / world_size))
+    return shard_woz_positions(positions, rank, world_size, seed), num_samples
+
+
+def read_woz_dialogues(path, index, positions):
+    """
+    Parse only the dialogues at the given positions, seeking straight to each of them in the split file.
+    :param path:
+    :param index:
+    :param positions:
+    :return:
+    """
+    data = []
+    with open(path, mode='rb') as f:
+        for position in positions:
+            entry = index["dialogues"][position]
+            f.seek(entry["offset"])
+            data.append(json.loads(f.read(entry["length"]).decode('utf8')))
+    return data
+
+
+def normalise_text(text):
+    text = text.replace("(", "").replace(")", "").replace('"', "").replace(u"’", "'").replace(u"‘", "'")
+    text = text.replace("\t", "").replace("\n", "").replace("\r", "").strip().lower()
+    text = text.replace(',', ' ').replace('.', ' ').replace('?', ' ').replace('-', ' ').replace('/', ' / ').replace(':', ' ')
+    return text
+
+
+def count_words(text):
+    """
+    Count the words process_text would turn into vectors, without looking any of them up.
+    """
+    return sum(1 for word in normalise_text(text).split() if word.replace("'", "").replace("!", ""))
+
+
 def process_text(text, word_vectors, ontology=None, print_mode=False):
     """
     Process a line/sentence converting words to feature vectors
@@ -149,9 +470,7 @@ def process_text(text, word_vectors, ontology=None, print_mode=False):
     :param print_mode:
     :return:
     """
-    text = text.replace("(", "").replace(")", "").replace('"', "").replace(u"’", "'").replace(u"‘", "'")
-    text = text.replace("\t", "").replace("\n", "").replace("\r", "").strip().lower()
-    text = text.replace(',', ' ').replace('.', ' ').replace('?', ' ').replace('-', ' ').replace('/', ' / ').replace(':', ' ')
+    text = normalise_text(text)
     if ontology:
         for slot in ontology:
             [domain, slot, value] = slot.split('-')
@@ -173,8 +492,8 @@ def process_text(text, word_vectors, ontology=None, print_mode=False):
                     vec = word_vectors[word[:i]] + word_vectors[word[i:]]
                     break
             else:
+                # Not stored in word_vectors, so how later words are split does not depend on what was seen before
                 vec = xavier_vector(word)
-                word_vectors[word] = vec
                 if print_mode:
                     print("[Info] Adding new word: %s" % word)
         else:
@@ -183,6 +502,30 @@ def process_text(text, word_vectors, ontology=None, print_mode=False):
     return np.asarray(vectors, dtype='float32')
 
 
+def normalise_belief_slot(slot, value):
+    """
+    Map a belief state slot and value onto the names used by the ontology.
+    Returns None when the pair does not correspond to any label.
+    """
+    if slot == 'name':
+        return None
+    if "book" in slot:
+        [slot, value] = slot.split(" ")
+    if value == '' or value == 'corsican':
+        return None
+    if slot == "destination" or slot == "departure":
+        value = "place"
+    elif value == '09;45':
+        value = '09:45'
+    elif 'alpha-milton' in value:
+        value = value.replace('alpha-milton', 'alpha milton')
+    elif value == 'east side':
+        value = 'east'
+    elif value == ' expensive':
+        value = 'expensive'
+    return slot, value
+
+
 def process_turn(turn, word_vectors, ontology, domains):
     user_input = turn['user']['text']
     sys_res = turn['system']
@@ -197,22 +540,9 @@ def process_turn(turn, word_vectors, ontology, domains):
         slots = state[domain]['semi']
         domain_mention = False
         for slot in slots:
-            if slot == 'name':
-                continue
-            value = slots[slot]
-            if "book" in slot:
-                [slot, value] = slot.split(" ")
-            if value != '' and value != 'corsican':
-                if slot == "destination" or slot == "departure":
-                    value = "place"
-                elif value == '09;45':
-                    value = '09:45'
-                elif 'alpha-milton' in value:
-                    value = value.replace('alpha-milton', 'alpha milton')
-                elif value == 'east side':
-                    value = 'east'
-                elif value == ' expensive':
-                    value = 'expensive'
+            slot_value = normalise_belief_slot(slot, slots[slot])
+            if slot_value is not None:
+                slot, value = slot_value
                 labels[ontology.index(domain + '-' + slot + '-' + value)] = 1
                 domain_mention = True
         if domain_mention: